@@ -22,6 +22,7 @@ import numpy as np
 import os
 import numba
 import time
+import functools
 import dask
 
 import dask.array as da
@@ -48,7 +49,12 @@ plt.rcParams["figure.figsize"] = [12., 8.]
 SAVEFIG = True
 # -
 
-cluster = LocalCluster(n_workers=1, threads_per_worker=8)
+# Worker processes sidestep the GIL in the pair bookkeeping and argmax
+# reductions; two threads per worker are left for the FFT and BLAS calls,
+# capped via the environment to avoid oversubscription.
+os.environ['OMP_NUM_THREADS'] = '2'
+os.environ['MKL_NUM_THREADS'] = '2'
+cluster = LocalCluster(n_workers=max(1, os.cpu_count() // 2), threads_per_worker=2)
 client = Client(cluster)
 client.upload_file('registration.py')
 client
@@ -81,6 +87,10 @@ start, stop = 42, -1 #BF
 stride = 5
 # dE is the blocksize used by dask, the number of images computed for at once.
 dE = 10
+# Load chunks of stride*dE images, so that the strided selection below yields
+# at most dE images per chunk, aligned after the first (possibly partial)
+# chunk, and no rechunk (shuffle) is needed in the graph.
+time_chunk = stride * dE
 
 Eslice = slice(start, stop, stride)
 
@@ -89,7 +99,7 @@ fftsize=256 * 2 // 2
 z_factor = 1
 # -
 
-dataset = xr.open_dataset(os.path.join(folder, name + '_detectorcorrected.nc'), chunks={'time': dE})
+dataset = xr.open_dataset(os.path.join(folder, name + '_detectorcorrected.nc'), chunks={'time': time_chunk, 'x': -1, 'y': -1})
 original = dataset.Intensity.data
 
 # For interactive use we can view the original data
@@ -103,18 +113,33 @@ extent = (center[0]-fftsize, center[0]+fftsize, center[1]-fftsize, center[1]+fft
 fftsize = max(extent[1]-extent[0], extent[3]-extent[2]) //2 # used in calc half matrices
 
 # Step 1 to 3 of the algorithm as described in section 4 of the paper.
-sobel = Reg.crop_and_filter_extent(original[Eslice, ...].rechunk({0: dE}), extent, sigma=sigma)
-#sobel = crop_and_filter(original[Eslice,...].rechunk({0:dE}), sigma=3, finalsize=2*fftsize)
+sobel = Reg.crop_and_filter_extent(original[Eslice, ...], extent, sigma=sigma)
+#sobel = crop_and_filter(original[Eslice,...], sigma=3, finalsize=2*fftsize)
 sobel = (sobel - sobel.mean(axis=(1,2), keepdims=True)) #.persist()  
 sobel
 
 # Step 4 of the algorithm as described in paper.
-Corr = dask_cross_corr(sobel)
+# Persist the spectra once; every pair correlation is then a single
+# inverse FFT away instead of a full-stack recomputation.
+sobel_fft = dask_spectra(sobel).persist()
+Corr = dask_cross_corr(sobel, spectra=sobel_fft)
 Corr
 
 # +
 # Plot combination of original images, filtered images, crosscorrelation 
 # for illustration purposes
+
+# Cache correlation planes host-side: each slider tick costs at most
+# one inverse FFT from the persisted spectra, and repeats are free.
+@functools.lru_cache(maxsize=32)
+def corr_slice(i, j):
+    if i == j:
+        # The autocorrelation planes are not part of the pair stack
+        F = sobel_fft[i].compute()
+        return corr_from_spectra(F * F.conj(), sobel.shape[1:])
+    return Corr[triu_index(i, j, sobel.shape[0])].compute()
+
+
 def plot_corr(i,j, save=SAVEFIG):
     #fig = plt.figure(figsize=(8.2, 3.5), constrained_layout=True)
     fig = plt.figure(figsize=(4, 7), constrained_layout=True)
@@ -143,7 +168,11 @@ def plot_corr(i,j, save=SAVEFIG):
     ax2.set_title(f'j={j*stride + start}')
     ax3.imshow(sobel[j,...].T,
                cmap='gray', interpolation='none')
-    im = ax4.imshow(Corr[i,j,...].compute().T, extent=[-fftsize, fftsize, -fftsize, fftsize], interpolation='none')
+    # Corr only holds the pairs i<j; the reversed pair is the mirrored correlation
+    corr_im = corr_slice(min(i, j), max(i, j))
+    if i > j:
+        corr_im = np.roll(corr_im[::-1, ::-1], 1, axis=(0, 1))
+    im = ax4.imshow(corr_im.T, extent=[-fftsize, fftsize, -fftsize, fftsize], interpolation='none')
     ax4.axhline(0, color='white', alpha=0.5)
     ax4.axvline(0, color='white', alpha=0.5)
     for ax in [ax2, ax3]:
@@ -164,12 +193,12 @@ widget = interactive(plot_corr,
 display(widget)
 # -
 
-# Step 5 of the algorithm
-weights, argmax = max_and_argmax(Corr)
+# Step 5 of the algorithm, fused with the inverse FFTs of step 4
+weights, argmax = max_and_argmax(cross_corr_max(sobel, spectra=sobel_fft))
 
 # Do actual computations; get a cup of coffee. If this takes to long, consider increasing stride to reduce the workload, at the cost of accuracy
 t = time.monotonic()
-W, DX_DY = calculate_halfmatrices(weights, argmax, fftsize=fftsize)
+W, DX, DY = calculate_halfmatrices(weights, argmax, fftsize=fftsize, diagonal=autocorr_weights(sobel))
 print(time.monotonic()-t)
 
 # Step 6 of the algorithm
@@ -182,8 +211,8 @@ def plot_masking(min_normed_weight, save=SAVEFIG):
     extent = [start, stop, stop, start]
     fig, axs = plt.subplots(1, 3, figsize=(8, 2.5), constrained_layout=True)
     im = {}
-    im[0] = axs[0].imshow(DX_DY[0], cmap='seismic', extent=extent, interpolation='none')
-    im[1] = axs[1].imshow(DX_DY[1], cmap='seismic', extent=extent, interpolation='none')
+    im[0] = axs[0].imshow(DX, cmap='seismic', extent=extent, interpolation='none')
+    im[1] = axs[1].imshow(DY, cmap='seismic', extent=extent, interpolation='none')
     im[2] = axs[2].imshow(W_n - np.diag(np.diag(W_n)), cmap='inferno', 
                           extent=extent, clim=(0.0, None), interpolation='none')
     axs[0].set_ylabel('$j$')
@@ -221,9 +250,9 @@ display(widget)
 # Part two of step 7 of the algorithm
 min_norm = widget.result
 nr = np.arange(W.shape[0])*stride + start
-coords, weightmatrix, DX, DY, row_mask = threshold_and_mask(min_norm, W, DX_DY, nr)
+coords, weightmatrix, DXr, DYr, row_mask = threshold_and_mask(min_norm, W, DX, DY, nr)
 #Step 8 of the algorithm: reduce the shift matrix to two vectors of absolute shifts
-dx, dy = calc_shift_vectors(DX, DY, weightmatrix)
+dx, dy = calc_shift_vectors(DXr, DYr, weightmatrix)
 plt.plot(coords, dx, '.', label='dx')
 plt.plot(coords, dy, '.', label='dy')
 plt.xlabel('n')
@@ -233,27 +262,20 @@ plt.legend()
 # Interpolate the shifts for all values not in coords
 shifts = np.stack(interp_shifts(coords, [dx, dy], n=original.shape[0]), axis=1)
 neededMargins = np.ceil(shifts.max(axis=0)).astype(int)
-shifts = da.from_array(shifts, chunks=(dE,-1))
+shifts = da.from_array(shifts, chunks=(original.chunks[0], -1))
 shifts
 
 
 # +
 #Step 9, the actual shifting of the original images
 
-#Inferring output dtype is not supported in dask yet, so we need original.dtype here.
-@da.as_gufunc(signature="(i,j),(2)->(i,j)", output_dtypes=original.dtype, vectorize=True)
-def shift_images(image, shift):
-    """Shift `image` by `shift` pixels."""
-    return ndi.shift(image, shift=shift, order=1)
-
-padded = da.pad(original.rechunk({0:dE}), 
-                ((0, 0), 
-                 (0, neededMargins[0]), 
-                 (0, neededMargins[1])
-                ),
-                mode='constant'
-               )
-corrected = shift_images(padded.rechunk({1:-1, 2:-1}), shifts)
+# shift_images from the registration package shifts each block of images
+# with a single parallel numba kernel instead of a python loop of
+# ndi.shift calls.
+# The pad margins are virtual: the kernel reads out-of-range samples as
+# zero, so no padded copy of the stack is materialized.
+corrected = shift_images(original, shifts,
+                         margins=(neededMargins[0], neededMargins[1]))
 # -
 
 # Do an interactive viewer to inspect the results
@@ -262,21 +284,19 @@ interactive(lambda n: plot_stack(corrected, n, grid=True),
            ) 
 
 # ## Saving data
-# Save the resulting data in a new netCDF file
+# Stream the shifted images straight to a compressed zarr store: the store is chunked like the shift blocks, so dask fuses shift-and-write into a single pass per chunk and the full corrected stack never materializes in memory. Bit shuffling with zstd compresses this data noticeably better than byte shuffling.
+
+import zarr
+from numcodecs import Blosc
+compressor = Blosc(cname='zstd', clevel=1, shuffle=Blosc.BITSHUFFLE)
+store = corrected.to_zarr(os.path.join(folder, name + '_driftcorrected.zarr'),
+                          overwrite=True, compressor=compressor, compute=False)
+dask.compute(store)
+
+# Alternatively, wrap the result in xarray and save as netCDF (this computes the whole stack again). The PCA notebooks (5a/5b) read this `_driftcorrected.nc` file, so run this cell before continuing with those.
 
 xrcorrected = dataset.reindex({'x': np.arange(0, dataset.x[1]*corrected.shape[1], dataset.x[1]), 
                                'y': np.arange(0, dataset.y[1]*corrected.shape[2], dataset.y[1])})
 xrcorrected.Intensity.data = corrected
 xrcorrected.Intensity.attrs['DriftCorrected'] = 'True'
 xrcorrected.to_netcdf(os.path.join(folder, name + '_driftcorrected.nc'))
-
-# Or, save the results to zarr
-import zarr
-from numcodecs import Blosc
-compressor = Blosc(cname='zstd', clevel=1, shuffle=Blosc.SHUFFLE)
-corrected.to_zarr(os.path.join(folder, name + '_driftcorrected.zarr'), 
-                  overwrite=True, compressor=compressor)
-
-#Or, although parallel access to HDF5 is hard, so go single process, save to hdf5
-with dask.config.set(scheduler='threads'):  
-    corrected.to_hdf5(os.path.join(folder, name + '_driftCorrected.h5', '/Intensity')
@@ -28,7 +28,11 @@ import scipy.ndimage as ndi
 
 folder = r'./data'
 name = '20171120_160356_3.5um_591.4_IVhdr'
-original = xr.open_dataset(os.path.join(folder, name + '_detectorcorrected.nc'), chunks={'time': 1})
+# dE is the dask blocksize along the energy axis; load the data in these blocks
+# directly, with full images per chunk, so only the strided selection below
+# needs a rechunk.
+dE = 10
+original = xr.open_dataset(os.path.join(folder, name + '_detectorcorrected.nc'), chunks={'time': dE, 'x': -1, 'y': -1})
 original = original.Intensity.data
 
 # Define fftsize used for the drift correction algorithm; actual size of the fft is twice this value.
@@ -51,17 +55,16 @@ res.coords
 
 # Before we can start, we connect to the dask-scheduler and upload the used functions
 
-cluster = LocalCluster()
+os.environ['OMP_NUM_THREADS'] = '2'
+os.environ['MKL_NUM_THREADS'] = '2'
+cluster = LocalCluster(n_workers=max(1, os.cpu_count() // 2), threads_per_worker=2)
 client = Client(cluster)
 client.upload_file('Registration.py')
 client
 
 
-# Inferring output dtype is not supported in dask yet, so we need original.dtype here.
-@da.as_gufunc(signature="(i,j),(2)->(i,j)", output_dtypes=original.dtype, vectorize=True)
-def shift_images(image, shift):
-    """Shift `image` by `shift` pixels."""
-    return ndi.shift(image, shift=shift, order=1)
+# The shifting is done by registration.shift_images: one numba kernel call
+# per block of dE images instead of a python loop of ndi.shift calls.
 
 
 tstart = time.time()
@@ -71,33 +74,26 @@ for stride in strides:
         for i in iters:
             t[0] = time.time() - tstart
             #start, stride, dE = 40, 1, 10
-            start, stop, dE = 40, 740, 10
+            start, stop = 40, 740
             #stop = start + n
             Eslice = slice(start, stop, stride)
             sliced_data = original[Eslice,...].rechunk({0:dE})
             sobel = crop_and_filter(sliced_data, 
                                     sigma=sigma, finalsize=2*fftsize)
             sobel = sobel - sobel.mean(axis=(1,2), keepdims=True)  
-            Corr = dask_cross_corr(sobel)
-            weights, argmax = max_and_argmax(Corr)
-            W, DX_DY = calculate_halfmatrices(weights, argmax, fftsize=fftsize)
+            weights, argmax = max_and_argmax(cross_corr_max(sobel))
+            W, DX, DY = calculate_halfmatrices(weights, argmax, fftsize=fftsize, diagonal=autocorr_weights(sobel))
             t[1] = (time.time() - (t[0]+tstart))
             coords = np.arange(sliced_data.shape[0])
-            coords, weightmatrix, DX, DY, row_mask = threshold_and_mask(0.0, W, DX_DY, coords=coords)
+            coords, weightmatrix, DX, DY, row_mask = threshold_and_mask(0.0, W, DX, DY, coords=coords)
             t[2] = (time.time() - (t[0]+tstart))
             dx, dy = calc_shift_vectors(DX, DY, weightmatrix)
             t[3] = (time.time() - (t[0]+tstart))
             shifts = np.stack(interp_shifts(coords, [dx, dy], n=sliced_data.shape[0]), axis=1)
             neededMargins = np.ceil(shifts.max(axis=0)).astype(int)
             shifts = da.from_array(shifts, chunks=(dE,-1))
-            padded = da.pad(sliced_data, 
-                            ((0, 0), 
-                             (0, neededMargins[0]), 
-                             (0, neededMargins[1])
-                            ),
-                            mode='constant'
-                           )
-            corrected = shift_images(padded.rechunk({1:-1, 2:-1}), shifts)
+            corrected = shift_images(sliced_data, shifts,
+                                     margins=(neededMargins[0], neededMargins[1]))
             corrected[:sliced_data.shape[0]].to_zarr(r'./tempresult.zarr', overwrite=True)
             t[4] = (time.time() - (t[0]+tstart))
             res.loc[dict(i=i,sigma=sigma,strides=stride)] = t
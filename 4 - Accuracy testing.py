@@ -23,7 +23,6 @@ import matplotlib.pyplot as plt
 import xarray as xr
 import os
 
-from scipy.ndimage.interpolation import shift
 from dask.distributed import Client, LocalCluster
 from Registration import *
 
@@ -62,18 +61,13 @@ trueshifts = xr.DataArray(np.stack([xshifts, yshifts]),
 trueshifts.plot(hue='direction')
 
 
-# Next, we apply the shifts to (copies of the annulus image) to create the dataset. Once again using `dask` and `gufunc`s allows for effortless streaming and parallelization.
+# Next, we apply the shifts to (copies of the annulus image) to create the dataset. Using `shift_images` from the registration package keeps the streaming and parallelization, with one numba kernel call per block instead of a python loop.
 
 # +
-@da.as_gufunc(signature="(i,j),(2)->(i,j)", output_dtypes=float, vectorize=True)
-def shift_images(image, shifts):
-    """Shift copies of image over shiftsX and shiftsY."""
-    return shift(image, shift=shifts, order=1)
-
-da_annulus = da.from_array(annulus, chunks='auto' )
+da_annulus = da.stack([da.from_array(annulus)] * length).rechunk({0: dE})
 shifts = da.from_array(np.stack([xshifts, yshifts], axis=1), chunks=(dE,2))
 
-synthetic = shift_images(da_annulus, shifts) 
+synthetic = shift_images(da_annulus, shifts)
 
 
 # -
@@ -116,11 +110,10 @@ for A in As:
             sobel = only_filter(noisedata, 
                                     sigma=s, mode='nearest')
             sobel = sobel - sobel.mean(axis=(1,2), keepdims=True)  
-            Corr = dask_cross_corr(sobel)
-            weights, argmax = max_and_argmax(Corr)
-            W, DX_DY = calculate_halfmatrices(weights, argmax, fftsize=fftsize)
+            weights, argmax = max_and_argmax(cross_corr_max(sobel))
+            W, DX, DY = calculate_halfmatrices(weights, argmax, fftsize=fftsize, diagonal=autocorr_weights(sobel))
             coords = np.arange(W.shape[0])
-            coords, weightmatrix, DX, DY, row_mask = threshold_and_mask(0.0, W, DX_DY, coords=coords)
+            coords, weightmatrix, DX, DY, row_mask = threshold_and_mask(0.0, W, DX, DY, coords=coords)
             dx, dy = calc_shift_vectors(DX, DY, weightmatrix, wpower=4)
             ddx, ddy = interp_shifts(coords, [dx,dy], length)
             res.loc[dict(s=s, A=A, direction='x')] = ddx
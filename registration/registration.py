@@ -1,15 +1,68 @@
 """Functions used for registering stacks of images, e.g. spectroscopic data"""
+import itertools
+import os
+import pickle
+
 import numpy as np
 import dask.array as da
 import dask
 from dask.delayed import delayed
-from scipy.optimize import least_squares
+import scipy.fft as fft
 import scipy.ndimage as ndi
-from scipy.interpolate import interp1d
 import scipy.sparse as ssp
-from skimage import filters
+from skimage.util import img_as_float
 import numba
 
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+else:
+    # Serve the scipy.fft calls in this module through FFTW. The
+    # interface cache keeps planned transforms alive between calls, so
+    # the N^2/2 pair transforms of a run all reuse one plan per shape.
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(60)
+    fft.set_global_backend(pyfftw.interfaces.scipy_fft)
+
+# User cache, not the package directory: a checkout should not grow
+# untracked files and an installed copy may not be writable.
+_wisdom_file = os.path.join(
+    os.environ.get('XDG_CACHE_HOME',
+                   os.path.join(os.path.expanduser('~'), '.cache')),
+    'leem-analysis', 'fftw_wisdom.pickle')
+
+
+def load_fftw_wisdom(filename=_wisdom_file):
+    """Load FFTW planning wisdom saved by `save_fftw_wisdom`.
+
+    Called once at import; no-op if pyfftw is not installed or no
+    wisdom has been saved yet."""
+    if pyfftw is None or not os.path.exists(filename):
+        return
+    with open(filename, 'rb') as f:
+        pyfftw.import_wisdom(pickle.load(f))
+
+
+def save_fftw_wisdom(filename=_wisdom_file):
+    """Save the FFTW planning wisdom accumulated so far, so future runs
+    start from the measured plans instead of re-planning.
+
+    No-op if pyfftw is not installed."""
+    if pyfftw is None:
+        return
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wb') as f:
+        pickle.dump(pyfftw.export_wisdom(), f)
+
+
+load_fftw_wisdom()
+
 
 def filter_block(block, sigma, mode='nearest'):
     """Perform Gaussian and Sobel filtering on a block of images
@@ -19,9 +72,47 @@ def filter_block(block, sigma, mode='nearest'):
     return np.stack([GSfilter(image, sigma, mode) for image in block])
 
 
+@numba.njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+def sobel_mag(img, out):
+    """Sobel gradient magnitude of a single image.
+
+    A single pass over unit-stride rows that LLVM can autovectorize,
+    instead of two separate `ndi.sobel` convolutions and a `hypot`.
+    Indices are clamped at the borders, which for the radius-1 kernel
+    is identical to ndi's 'reflect' mode.
+    """
+    h, w = img.shape
+    for y in numba.prange(h):
+        ym = y - 1 if y > 0 else 0
+        yp = y + 1 if y < h - 1 else h - 1
+        for x in range(w):
+            xm = x - 1 if x > 0 else 0
+            xp = x + 1 if x < w - 1 else w - 1
+            gy = (img[yp, xm] + 2*img[yp, x] + img[yp, xp]
+                  - img[ym, xm] - 2*img[ym, x] - img[ym, xp])
+            gx = (img[ym, xp] + 2*img[y, xp] + img[yp, xp]
+                  - img[ym, xm] - 2*img[y, xm] - img[yp, xm])
+            out[y, x] = np.sqrt(gx*gx + gy*gy)
+    return out
+
+
 def GSfilter(image, sigma, mode):
-    """Combine a Sobel and a Gaussian filter"""
-    return filters.sobel(filters.gaussian(image, sigma=sigma, mode=mode))
+    """Combine a Sobel and a Gaussian filter
+
+    The Gaussian is applied as a separable pair of 1-D convolutions,
+    the Sobel as a numba stencil. The scaling reproduces
+    `skimage.filters.sobel(skimage.filters.gaussian(...))` exactly:
+    `sobel_mag` uses the separable [1,2,1] x [-1,0,1] pair, 4 times
+    skimage's normalized kernel, and the gradient magnitude carries
+    another 1/sqrt(2).
+
+    Filtering happens in float32: single precision is ample for the
+    correlation peaks and halves the bytes moved by everything
+    downstream.
+    """
+    image = img_as_float(image).astype(np.float32, copy=False)
+    smooth = ndi.gaussian_filter(image, sigma=sigma, mode=mode)
+    return sobel_mag(smooth, np.empty_like(smooth)) / np.float32(4 * np.sqrt(2))
 
 
 def crop_and_filter(images, sigma=11, mode='nearest', finalsize=256):
@@ -33,7 +124,7 @@ def crop_and_filter(images, sigma=11, mode='nearest', finalsize=256):
     halfsize = finalsize//2 + sigma
     result = images[:, (cent[0]-halfsize):(cent[0]+halfsize),
                     (cent[1]-halfsize):(cent[1]+halfsize)]
-    result = result.map_blocks(filter_block, dtype=np.float64,
+    result = result.map_blocks(filter_block, dtype=np.float32,
                                sigma=sigma, mode=mode)
     if sigma > 0:
         result = result[:, sigma:-sigma, sigma:-sigma]
@@ -44,23 +135,257 @@ def crop_and_filter_extent(images, extent, sigma=11, mode='nearest'):
     to prevent edge effects of the filters. extent = minx,maxx,miny,maxy of ROI"""
     result = images[:, extent[0]-sigma:extent[1]+sigma,
                     extent[2]-sigma:extent[3]+sigma]
-    result = result.map_blocks(filter_block, dtype=np.float64,
+    result = result.map_blocks(filter_block, dtype=np.float32,
                                sigma=sigma, mode=mode)
     if sigma > 0:
         result = result[:, sigma:-sigma, sigma:-sigma]
     return result
 
-def dask_cross_corr(data):
+def rfft2_block(block, workers=-1):
+    """rFFT over the last two axes of a block of images,
+    using the multi-threaded `scipy.fft`."""
+    return fft.rfft2(block, axes=(-2, -1), workers=workers)
+
+
+def corr_from_spectra(spectra, s, workers=-1):
+    """Transform products of rFFT spectra back to (fftshifted)
+    cross correlations over the last two axes."""
+    corr = fft.irfft2(spectra, s=s, axes=(-2, -1), workers=workers)
+    return fft.fftshift(corr, axes=(-2, -1))
+
+
+def dask_spectra(data):
+    """Return the dask array of rFFT spectra of a stack of images
+    (uncomputed). Each chunk is transformed only once, so the spectra
+    can be reused for all pairs of images."""
+    s = data.shape[1:]
+    # complex64 spectra for float32 input, complex128 for float64
+    cdtype = np.result_type(data.dtype, np.complex64)
+    return data.map_blocks(rfft2_block, dtype=cdtype,
+                           chunks=data.chunks[:-1] + ((s[-1]//2 + 1,),))
+
+
+def triu_index(i, j, n):
+    """Index of the pair ``(i, j)``, with ``i < j``, in the flat upper
+    triangular ordering generated by `itertools.combinations(range(n), 2)`."""
+    return i*(2*n - i - 1)//2 + (j - i - 1)
+
+
+def autocorr_weights(data):
+    """Zero-lag autocorrelation (total energy) of each image.
+
+    These are the diagonal entries of the weight matrix, needed to
+    normalize the off-diagonal weights in `threshold_and_mask`.
+    Accumulated in float64 also for single precision images."""
+    return (data**2).sum(axis=(1, 2), dtype=np.float64)
+
+
+@delayed(pure=True)
+def _pair_corr(Fi, Fj, s):
+    """Cross correlation of a single pair of images from their spectra."""
+    return corr_from_spectra(Fi * Fj.conj(), s)
+
+
+def _parabolic_refine(corr, py, px):
+    """Sub-pixel refinement of integer peak locations (py, px) of a
+    stack of correlation planes by a three-point parabolic fit along
+    each axis. Peaks on the border are left unrefined.
+
+    Works on both numpy and cupy arrays."""
+    xp = np if cupy is None else cupy.get_array_module(corr)
+    npairs, h, w = corr.shape
+    r = xp.arange(npairs)
+    c0 = corr[r, py, px]
+    ry = xp.zeros(npairs)
+    rx = xp.zeros(npairs)
+    for offset, neighbors in ((ry, (corr[r, py-1, px], corr[r, (py+1) % h, px])),
+                              (rx, (corr[r, py, px-1], corr[r, py, (px+1) % w]))):
+        cm, cp = neighbors
+        denom = cm - 2*c0 + cp
+        good = denom != 0
+        offset[good] = 0.5*(cm[good] - cp[good]) / denom[good]
+    interior = (py > 0) & (py < h - 1) & (px > 0) & (px < w - 1)
+    return xp.where(interior, py + ry, py), xp.where(interior, px + rx, px)
+
+
+@delayed(pure=True)
+def _block_peaks(Fa, Fb, s, same, subpixel=True):
+    """Peak values and peak locations of the cross correlations of
+    all pairs between two blocks of spectra, batched through a single
+    inverse FFT, without keeping the correlation planes. Locations
+    are parabolically refined to sub-pixel precision unless
+    `subpixel` is False.
+
+    For `same` blocks only the pairs i<j are formed, in
+    `itertools.combinations` order; otherwise the full outer product
+    of the blocks, row-major."""
+    if same:
+        i, j = np.triu_indices(Fa.shape[0], 1)
+        prod = Fa[i] * Fb[j].conj()
+    else:
+        prod = (Fa[:, np.newaxis] * Fb[np.newaxis].conj())
+        prod = prod.reshape((-1,) + Fa.shape[1:])
+    corr = corr_from_spectra(prod, s)
+    flat = corr.reshape(corr.shape[0], -1)
+    am = flat.argmax(axis=1)
+    w = np.take_along_axis(flat, am[:, np.newaxis], axis=1)[:, 0]
+    py, px = np.unravel_index(am, s)
+    if subpixel:
+        py, px = _parabolic_refine(corr, py, px)
+    return np.stack([w, py, px], axis=1)
+
+
+def _image_spectra(data, spectra=None):
+    """List of per-image delayed rFFT spectra of a stack of images.
+
+    Each chunk is transformed only once and shared by all the
+    per-image tasks sliced out of it. Passing a precomputed (and
+    ideally persisted) `dask_spectra(data)` as `spectra` lets pair
+    tasks stream slices from (distributed) memory instead of
+    re-transforming."""
+    F = dask_spectra(data) if spectra is None else spectra
+    blocks = F.to_delayed().ravel()
+    offsets = np.cumsum((0,) + F.chunks[0])
+
+    def spectrum(i):
+        b = np.searchsorted(offsets, i, side='right') - 1
+        return blocks[b][i - offsets[b]]
+
+    return [spectrum(i) for i in range(data.shape[0])]
+
+
+def dask_cross_corr(data, spectra=None):
     """Return the dask array with the crosscorrelations of data
     (uncomputed)
+
+    As Corr[j, i] is Corr[i, j] reversed for real input, only the
+    pairs ``i < j`` are computed, halving the pairwise work. The
+    result is a flat (N*(N-1)//2, *data.shape[1:]) stack in the
+    ordering of `itertools.combinations`; use `triu_index` to find
+    the entry of a specific pair. The rFFT of each image is computed
+    only once and reused for all of its partners, with each (inverse)
+    transform multi-threaded via `scipy.fft`. A persisted
+    `dask_spectra(data)` can be passed as `spectra` to reuse
+    transforms across several calls.
+    """
+    N = data.shape[0]
+    s = data.shape[1:]
+    spectra = _image_spectra(data, spectra)
+    corrs = [da.from_delayed(_pair_corr(spectra[i], spectra[j], s),
+                             shape=s, dtype=data.dtype)
+             for i, j in itertools.combinations(range(N), 2)]
+    return da.stack(corrs)
+
+
+def cross_corr_max(data, spectra=None, subpixel=True):
+    """Fused equivalent of ``max_and_argmax(dask_cross_corr(data))``
+    (uncomputed), with sub-pixel peak refinement.
+
+    The peak search happens inside each pair task, so only two
+    (N*(N-1)//2,) vectors escape and the pair correlation planes are
+    never stored. Instead of one task per pair, all pairs between two
+    dE-chunks of spectra are batched through a single inverse FFT, so
+    the graph holds ~(N/dE)^2/2 tasks and the scheduler is not
+    swamped for large N. A persisted `dask_spectra(data)` can be
+    passed as `spectra` to reuse transforms across several calls. For
+    a GPU equivalent see `cross_corr_max_cupy`.
+
+    The peak location of each pair is refined by a three-point
+    parabolic fit along both axes inside the same task, reusing the
+    correlation plane while it is still hot, unless `subpixel` is
+    False.
+
+    Returns
+    -------
+    weights : dask array (N*(N-1)//2,)
+        peak value per pair, ordering as in `dask_cross_corr`
+    argmax : dask array (N*(N-1)//2, 2)
+        (y, x) position of each peak in the fftshifted plane
+    """
+    N = data.shape[0]
+    s = data.shape[1:]
+    F = dask_spectra(data) if spectra is None else spectra
+    blocks = F.to_delayed().ravel()
+    offsets = np.cumsum((0,) + F.chunks[0])
+    results = []
+    order = []
+    for a in range(len(blocks)):
+        ia = np.arange(offsets[a], offsets[a+1])
+        for b in range(a, len(blocks)):
+            jb = np.arange(offsets[b], offsets[b+1])
+            if a == b:
+                ti, tj = np.triu_indices(len(ia), 1)
+                ii, jj = ia[ti], ia[tj]
+            else:
+                ii, jj = np.repeat(ia, len(jb)), np.tile(jb, len(ia))
+            if len(ii) == 0:
+                continue
+            results.append(da.from_delayed(
+                _block_peaks(blocks[a], blocks[b], s, same=(a == b),
+                             subpixel=subpixel),
+                shape=(len(ii), 3), dtype=np.float64))
+            order.append(triu_index(ii, jj, N))
+    if not results:
+        # A single image has no pairs; keep the output shapes so
+        # `calculate_halfmatrices` still reconstructs the 1x1 matrices
+        return np.zeros(0), np.zeros((0, 2))
+    peaks = da.concatenate(results)
+    # Restore the canonical flat triangular (combinations) ordering
+    order = np.concatenate(order)
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(len(order))
+    peaks = peaks[inverse]
+    return peaks[:, 0], peaks[:, 1:]
+
+
+def cross_corr_max_cupy(data, blocksize=32, subpixel=True):
+    """Cross correlate all pairs ``i < j`` on the GPU and return only
+    the peak height and location of each pair.
+
+    The rFFT of the full stack is computed once with a single batched
+    cuFFT call and kept in GPU memory; pairs are then processed in
+    blocks of `blocksize` batched inverse FFTs. Only the (P,)
+    reductions ever leave the GPU, the (P, x, y) correlation stack
+    itself never materializes. Requires the optional dependency
+    `cupy`.
+
+    Parameters
+    ----------
+    data : array_like (N, x, y)
+        stack of (filtered) images, anything `np.asarray` can consume
+    blocksize : int, default: 32
+        number of pairs per batched inverse FFT
+
+    Returns
+    -------
+    weights : numpy array (N*(N-1)//2,)
+        peak value per pair, ordering as in `dask_cross_corr`
+    argmax : numpy array (N*(N-1)//2, 2)
+        (y, x) position of each peak in the fftshifted plane,
+        parabolically refined unless `subpixel` is False
     """
-    # Define the Correlation `Corr` via FFT's:
-    F = da.fft.rfft2(data, axes=(1, 2))
-    Corr = da.fft.irfft2(F[:, np.newaxis, ...] * F.conj()[np.newaxis, ...],
-                         axes=(2, 3)
-                         ).real
-    Corr = da.fft.fftshift(Corr, axes=(2, 3))
-    return Corr
+    if cupy is None:
+        raise ImportError("cross_corr_max_cupy requires the optional dependency cupy")
+    data = np.asarray(data)
+    s = data.shape[1:]
+    F = cupy.fft.rfft2(cupy.asarray(data), axes=(1, 2))
+    pairs = np.array(list(itertools.combinations(range(data.shape[0]), 2)))
+    weights = np.empty(len(pairs))
+    argmax = np.empty((len(pairs), 2))
+    for k in range(0, len(pairs), blocksize):
+        i = cupy.asarray(pairs[k:k+blocksize, 0])
+        j = cupy.asarray(pairs[k:k+blocksize, 1])
+        corr = cupy.fft.irfft2(F[i] * F[j].conj(), s=s, axes=(1, 2))
+        corr = cupy.fft.fftshift(corr, axes=(1, 2))
+        am = corr.reshape(len(i), -1).argmax(axis=1)
+        py, px = cupy.unravel_index(am, s)
+        r = cupy.arange(len(i))
+        weights[k:k+blocksize] = cupy.asnumpy(corr[r, py, px])
+        if subpixel:
+            py, px = _parabolic_refine(corr, py, px)
+        argmax[k:k+blocksize, 0] = cupy.asnumpy(py)
+        argmax[k:k+blocksize, 1] = cupy.asnumpy(px)
+    return weights, argmax
 
 
 def max_and_argmax(data):
@@ -80,6 +405,10 @@ def max_and_argmax(data):
     argmax : dask array
         argmax of `data` along the last two axes
     """
+    if isinstance(data, tuple):
+        # Already reduced by a fused peak search such as
+        # `cross_corr_max`: pass through.
+        return data
     # Slap out a dimension to nicely apply argmax and max
     flatData = data.reshape(data.shape[:-2]+(-1,))
     argmax = da.argmax(flatData, axis=-1)
@@ -90,23 +419,83 @@ def max_and_argmax(data):
     return weights, argmax
 
 
-def calculate_halfmatrices(weights, argmax, fftsize=128):
-    """Compute the half matrices of the weights and the argmax
+@numba.njit(parallel=True, cache=True)
+def _fill_halfmatrices(uW, ux, uy, wdiag, N):
+    """Scatter the flat upper triangles into full symmetric weight and
+    antisymmetric displacement matrices.
+
+    Row-parallel with plain index arithmetic: each row i of the upper
+    triangle starts at flat index i*(2N-i-1)//2 (`triu_index`), so the
+    writes are sequential per row instead of one big fancy-indexed
+    scatter with its temporaries."""
+    W = np.zeros((N, N))
+    DX = np.zeros((N, N))
+    DY = np.zeros((N, N))
+    for i in numba.prange(N):
+        k = i*(2*N - i - 1)//2
+        W[i, i] = wdiag[i]
+        for j in range(i + 1, N):
+            W[i, j] = uW[k]
+            W[j, i] = uW[k]
+            DX[i, j] = ux[k]
+            DX[j, i] = -ux[k]
+            DY[i, j] = uy[k]
+            DY[j, i] = -uy[k]
+            k += 1
+    return W, DX, DY
+
+
+def calculate_halfmatrices(weights, argmax, fftsize=128, diagonal=None):
+    """Compute the upper triangle of the weights and the argmax
     and reconstruct the full arrays.
 
     Parameters
     ----------
     weights : dask array
+        either the flat (N*(N-1)//2,) upper triangle as produced from
+        `dask_cross_corr`, or a full square (N,N) matrix.
     argmax : dask array
+        either flat indices with the same shape as `weights`, or
+        (possibly sub-pixel) (P, 2) peak positions as produced by
+        `cross_corr_max`
     fftsize : int, default: 128
+    diagonal : dask array or None, default: None
+        the (N,) diagonal of the weight matrix, e.g. from
+        `autocorr_weights`. Required for flat triangular input.
 
     Returns
     -------
-    Wc : numpy array
+    Wc : numpy array (N,N)
         Computed weights, symmetric
-    Mc : numpy array
-        Computed locations of maxima
+    DX : numpy array (N,N)
+        Computed horizontal locations of maxima, antisymmetric
+    DY : numpy array (N,N)
+        Computed vertical locations of maxima, antisymmetric
+
+    The three matrices are returned as separate contiguous arrays, so
+    the masking in `threshold_and_mask` is a single boolean-index pass
+    per array.
     """
+    if weights.ndim == 1:
+        # Flat upper triangle of pairs i<j, in `itertools.combinations` order
+        P = weights.shape[0]
+        N = int(round((1 + np.sqrt(1 + 8*P)) / 2))
+        if diagonal is None:
+            raise ValueError("diagonal weights are required for flat triangular input,"
+                             " see `autocorr_weights`")
+        # Do actual computations, get a cup of coffee
+        uW, uM, wdiag = da.compute(weights, argmax, diagonal)
+        # Undo the flatten and compensate for the fft-shift
+        if uM.ndim == 2:
+            um = uM.T - fftsize  # already (sub-pixel) peak positions
+        else:
+            um = np.stack(np.unravel_index(uM, (fftsize*2, fftsize*2))) - fftsize
+        return _fill_halfmatrices(np.ascontiguousarray(uW, dtype=np.float64),
+                                  np.ascontiguousarray(um[0], dtype=np.float64),
+                                  np.ascontiguousarray(um[1], dtype=np.float64),
+                                  np.ascontiguousarray(wdiag, dtype=np.float64),
+                                  N)
+
     # Calculate half of the matrices only, because we know it is antisymmetric.
     uargmax = da.triu(argmax, 1)  # Diagonal shifts are zero anyway, so 1. Reconstruct after computation
 
@@ -121,10 +510,10 @@ def calculate_halfmatrices(weights, argmax, fftsize=128):
     Mc -= np.triu(np.full_like(Mc, fftsize), 1)  # Compensate for the fft-shift
     Mc = Mc - Mc.swapaxes(1, 2)  # Reconstruct full antisymmetric matrices
     # Mc = Mc / z_factor  # Compensate for zoomfactor
-    return Wc, Mc
+    return Wc, np.ascontiguousarray(Mc[0]), np.ascontiguousarray(Mc[1])
 
 
-def threshold_and_mask(min_normed_weight, W, Mc, coords):  # =np.arange(Wc.shape[0])*stride + start):
+def threshold_and_mask(min_normed_weight, W, DX, DY, coords):  # =np.arange(Wc.shape[0])*stride + start):
     """Normalize the weights W, threshold to min_normed_weight and remove diagonal,
     reduce DX and DY to the columns and rows still containing weights.
 
@@ -147,7 +536,6 @@ def threshold_and_mask(min_normed_weight, W, Mc, coords):  # =np.arange(Wc.shape
     mask = W_n - np.diag(np.diag(W_n)) > min_normed_weight
     row_mask = np.any(mask, axis=0)
     W_n = np.where(mask, W_n, 0)
-    DX, DY = Mc[0], Mc[1]
     W_n_m = W_n[:, row_mask][row_mask, :]
     coords = coords[row_mask]
     #mask_red = mask[row_mask, :][:, row_mask]
@@ -155,12 +543,15 @@ def threshold_and_mask(min_normed_weight, W, Mc, coords):  # =np.arange(Wc.shape
     return coords, W_n_m, DX_m, DY_m, row_mask
 
 
-def construct_jac(W):
-    """Construct a sparse Jacobian matrix of the least squares problem
-    from a weight matrix.
+def construct_diff_matrix(W):
+    """Construct the sparse weighted difference matrix of the least
+    squares problem from a weight matrix.
 
-    This Jacobian is independent of the position
-    vector dx as the problem is actually linear
+    Row k, corresponding to the pair (i, j), i<j, has exactly two
+    nonzeros: -W[i,j] in column i and +W[i,j] in column j, so
+    ``D @ x`` is the weighted vector of pairwise differences
+    W[i,j]*(x[j] - x[i]), matching the sign convention of the
+    displacement matrices.
 
     Parameters
     ----------
@@ -169,24 +560,28 @@ def construct_jac(W):
 
     Returns
     -------
-    sparse array (N, N*N)
-        Jacobian in compressed sparse row format
+    sparse array (N*(N-1)//2, N)
+        difference matrix in compressed sparse row format
     """
     N = W.shape[0]
-    i = np.arange(N)
-    j = i + N*i
-    data = np.ones(N)
-    A = ssp.coo_matrix((data, (i, j)), shape=(N, N*N)).tocsr()
-    wsp = ssp.csr_matrix(W)
-    J = wsp.dot(A)
-    J = J.reshape((N*N, N))
-    return J - wsp.T.dot(A).reshape((N*N, N), order='F')
+    i, j = np.triu_indices(N, 1)
+    w = np.asarray(W)[i, j]
+    k = np.arange(len(w))
+    return ssp.csr_matrix((np.concatenate([-w, w]),
+                           (np.concatenate([k, k]), np.concatenate([i, j]))),
+                          shape=(len(w), N))
 
 
 def calc_shift_vectors(DX, DY, weightmatrix, wpower=4, lsqkwargs={}):
     """From relative displacement matrices, compute absolute displacement
     vectors.
 
+    The problem is linear, so instead of an iterative optimizer a
+    single sparse linear least squares solve per direction suffices:
+    the weighted difference matrix has two nonzeros per row, making
+    each `lsqr` iteration O(N^2) instead of the O(N^3) dense matrix
+    products.
+
     Parameters
     ----------
     DX : array_like (N,N)
@@ -200,7 +595,7 @@ def calc_shift_vectors(DX, DY, weightmatrix, wpower=4, lsqkwargs={}):
         (componentwise)
     lsqkwargs : dict, default={}
         keyword arguments to pass to calls of
-        `scipy.optimize.least_squares`
+        `scipy.sparse.linalg.lsqr`
 
     Returns
     -------
@@ -210,23 +605,11 @@ def calc_shift_vectors(DX, DY, weightmatrix, wpower=4, lsqkwargs={}):
         vertical absolute shift vector
     """
     wopt = weightmatrix**wpower
-
-    @numba.jit(nopython=True, nogil=True)
-    def err_func(x, result):
-        x = np.atleast_2d(x)
-        epsilon = x - x.T - result
-        epsilon = epsilon * wopt
-        return epsilon.ravel()
-
-    Jac = construct_jac(wopt)
-    res = least_squares(err_func, DX[DX.shape[0]//2, :],
-                        jac=lambda x, Jargs: Jac,
-                        args=(DX,), **lsqkwargs)
-    dx = res['x']
-    res = least_squares(err_func, DY[DY.shape[0]//2, :],
-                        jac=lambda x, Jargs: Jac,
-                        args=(DY,), **lsqkwargs)
-    dy = res['x']
+    D = construct_diff_matrix(wopt)
+    i, j = np.triu_indices(wopt.shape[0], 1)
+    w = wopt[i, j]
+    dx = ssp.linalg.lsqr(D, w * np.asarray(DX)[i, j], **lsqkwargs)[0]
+    dy = ssp.linalg.lsqr(D, w * np.asarray(DY)[i, j], **lsqkwargs)[0]
     dx -= dx.min()
     dy -= dy.min()
     return dx, dy
@@ -254,14 +637,127 @@ def interp_shifts(coords, shifts, n=None):
         ns = np.arange(coords.min(), coords.max()+1)
     else:
         ns = np.arange(n)
-    shifts_interp = []
-    for dr in shifts:
-        f = interp1d(coords, dr, fill_value=(dr[0], dr[-1]),
-                     kind='linear', assume_sorted=True, bounds_error=False)
-        shifts_interp.append(f(ns))
+    # np.interp clamps to the first/last value outside of coords,
+    # just like interp1d with fill_value=(dr[0], dr[-1]), without
+    # constructing an interpolator object per vector.
+    shifts_interp = [np.interp(ns, coords, dr) for dr in shifts]
     #shift = da.from_array(shift, chunks=(dE,1,1))
     return np.array(shifts_interp)
 
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def shift_block_bilinear(images, shifts, my=0, mx=0):
+    """Shift a block of images in the x,y plane by shifts[index]
+    with explicit bilinear interpolation.
+
+    Parallelized over the images in the block with numba. Out of
+    bounds samples are zero, matching
+    `ndi.shift(..., order=1, mode='constant')`.
+
+    The output frames are `(my, mx)` larger than the input: the
+    bounds checks make the unpadded source behave as if it were
+    zero-padded, without ever materializing the padded stack.
+    """
+    n, h, w = images.shape
+    hp = h + my
+    wp = w + mx
+    out = np.zeros((n, hp, wp), dtype=images.dtype)
+    for k in numba.prange(n):
+        sy = shifts[k, 0]
+        sx = shifts[k, 1]
+        for y in range(hp):
+            fy = y - sy
+            # Sample coordinates outside the padded frame yield 0,
+            # like mode='constant'
+            if fy < 0 or fy > hp - 1:
+                continue
+            y0 = int(fy)
+            y1 = y0 + 1 if y0 < hp - 1 else y0
+            wy = fy - y0
+            for x in range(wp):
+                fx = x - sx
+                if fx < 0 or fx > wp - 1:
+                    continue
+                x0 = int(fx)
+                x1 = x0 + 1 if x0 < wp - 1 else x0
+                wx = fx - x0
+                # Taps landing in the virtual margin read 0
+                a00 = images[k, y0, x0] if y0 < h and x0 < w else 0.
+                a01 = images[k, y0, x1] if y0 < h and x1 < w else 0.
+                a10 = images[k, y1, x0] if y1 < h and x0 < w else 0.
+                a11 = images[k, y1, x1] if y1 < h and x1 < w else 0.
+                out[k, y, x] = ((1-wy) * ((1-wx) * a00 + wx * a01)
+                                + wy * ((1-wx) * a10 + wx * a11))
+    return out
+
+
+def shift_block_fourier(images, shifts, workers=-1):
+    """Shift a block of images in the x,y plane by shifts[index]
+    with a phase ramp in the Fourier domain.
+
+    An exact sub-pixel shift without interpolation artifacts, in
+    O(HW log HW) per image independent of the shift. The shift is
+    circular: content leaving one edge reenters at the opposite one,
+    so the images should carry a pad margin at least as large as the
+    largest shift (as `register_stack` provides)."""
+    h, w = images.shape[-2:]
+    F = fft.rfft2(images, axes=(-2, -1), workers=workers)
+    ky = fft.fftfreq(h)[:, np.newaxis]
+    kx = fft.rfftfreq(w)[np.newaxis, :]
+    phase = np.exp(-2j*np.pi * (ky * shifts[:, 0, np.newaxis, np.newaxis]
+                                + kx * shifts[:, 1, np.newaxis, np.newaxis]))
+    out = fft.irfft2(F * phase, s=(h, w), axes=(-2, -1), workers=workers)
+    return out.astype(images.dtype, copy=False)
+
+
+def _shift_block(block, shifts, method='bilinear', my=0, mx=0):
+    # Squeeze off the broadcast dimension added in `shift_images`
+    if method == 'fourier':
+        if my or mx:
+            # The circular Fourier shift needs the margin materialized
+            block = np.pad(block, ((0, 0), (0, my), (0, mx)))
+        return shift_block_fourier(block, shifts[..., 0])
+    return shift_block_bilinear(block, shifts[..., 0], my, mx)
+
+
+def shift_images(images, shifts, method='bilinear', margins=(0, 0)):
+    """Shift every image of `images` by its row of `shifts` (uncomputed).
+
+    Instead of a python-level loop of `ndi.shift` calls, every block of
+    dE images is processed by a single parallel numba kernel, or by a
+    batched FFT for the Fourier method.
+
+    Parameters
+    ----------
+    images : dask array (N, x, y)
+        stack of images, chunked along the stack axis only
+    shifts : dask array (N, 2)
+        shift per image, chunked to match `images`
+    method : {'bilinear', 'fourier'}, default: 'bilinear'
+        'bilinear' interpolates with `shift_block_bilinear`, zero
+        outside the image; 'fourier' applies the exact circular
+        phase-ramp shift of `shift_block_fourier`.
+    margins : tuple of int, default: (0, 0)
+        grow every output frame by this many pixels in x and y, as if
+        the input had been zero-padded with `da.pad`. The bilinear
+        kernel pads virtually through its bounds checks, so no padded
+        copy of the stack is ever created.
+
+    Returns
+    -------
+    dask array (N, x + margins[0], y + margins[1])
+        the shifted images
+    """
+    if method not in ('bilinear', 'fourier'):
+        raise ValueError(f"unknown shift method {method!r}")
+    my, mx = int(margins[0]), int(margins[1])
+    chunks = (images.chunks[0],
+              (images.shape[1] + my,),
+              (images.shape[2] + mx,))
+    return da.map_blocks(_shift_block, images, shifts[:, :, np.newaxis],
+                         dtype=images.dtype, chunks=chunks,
+                         method=method, my=my, mx=mx)
+
+
 # def shift_block(images, shifts, margins=(0,0)):
 #     """Shift a block of images per image in the x,y plane by shifts[index].
 #     Embed this in margins extra space"""
@@ -294,7 +790,7 @@ def only_filter(images, sigma=11, mode='nearest'):
     Cropped with a margin of sigma,
     to prevent edge effects of the filters.
     """
-    result = images.map_blocks(filter_block, dtype=np.float64,
+    result = images.map_blocks(filter_block, dtype=np.float32,
                                sigma=sigma, mode=mode)
     if sigma > 0:
         si = int(np.ceil(sigma))
@@ -332,31 +828,25 @@ def register_stack(data, sigma=5, fftsize=256, dE=10, min_norm=0.15):
         array of the computed shifts
     """
     data = da.asarray(data, chunks=(dE, -1, -1))
-    sobel = crop_and_filter(data.rechunk({0: dE}), sigma=sigma, finalsize=2*fftsize)
-    sobel = (sobel - sobel.mean(axis=(1, 2), keepdims=True)).persist()
-    corr = dask_cross_corr(sobel)
-    W, M = calculate_halfmatrices(*max_and_argmax(corr), fftsize=fftsize)
+    sobel = crop_and_filter(data, sigma=sigma, finalsize=2*fftsize)
+    sobel = (sobel - sobel.mean(axis=(1, 2), keepdims=True))
+    # Keep the spectra in (distributed) memory: every pair task
+    # streams two precomputed slices instead of re-FFT-ing its images.
+    F = dask_spectra(sobel).persist()
+    W, DX, DY = calculate_halfmatrices(*cross_corr_max(sobel, spectra=F),
+                                       fftsize=fftsize,
+                                       diagonal=autocorr_weights(sobel))
     #w_diag = np.atleast_2d(np.diag(W))
     #W_n = W / np.sqrt(w_diag.T * w_diag)
     nr = np.arange(data.shape[0])
-    coords, weightmatrix, DX, DY, row_mask = threshold_and_mask(min_norm, W, M, nr)
+    coords, weightmatrix, DX, DY, row_mask = threshold_and_mask(min_norm, W, DX, DY, nr)
     dx, dy = calc_shift_vectors(DX, DY, weightmatrix)
     shifts = np.stack(interp_shifts(coords, [dx, dy], n=data.shape[0]), axis=1)
     neededMargins = np.ceil(shifts.max(axis=0)).astype(int)
     shifts = da.from_array(shifts, chunks=(dE, -1))
-
-    @da.as_gufunc(signature="(i,j),(2)->(i,j)", output_dtypes=data.dtype, vectorize=True)
-    def shift_images(image, shifts):
-        """Shift `image` by `shift` pixels."""
-        return ndi.shift(image, shift=shifts, order=1)
-    padded = da.pad(data.rechunk({0: dE}),
-                    ((0, 0),
-                     (0, neededMargins[0]),
-                     (0, neededMargins[1])
-                     ),
-                    mode='constant'
-                    )
-    corrected = shift_images(padded.rechunk({1: -1, 2: -1}), shifts)
+    # The margins are padded virtually by the shift kernel
+    corrected = shift_images(data, shifts,
+                             margins=(neededMargins[0], neededMargins[1]))
     return corrected, shifts
 
 
@@ -394,48 +884,48 @@ def strided_register(data, sigma=5, fftsize=256, stride=10, min_norm=0.15, start
         array of the computed shifts
     W_full: (NxN) numpy array
         computed weights
-    M_full: (2xNxN) numpy array
-        computed relative shifts
+    DX_full: (NxN) numpy array
+        computed horizontal relative shifts
+    DY_full: (NxN) numpy array
+        computed vertical relative shifts
     """
     dE = stride
     data = da.asarray(data, chunks=(dE, -1, -1))
     nr = np.arange(start, data.shape[0])
-    sobel = crop_and_filter(data.rechunk({0: dE}), sigma=sigma, finalsize=2*fftsize)
-    sobel = (sobel - sobel.mean(axis=(1, 2), keepdims=True))#.persist()
+    sobel = crop_and_filter(data, sigma=sigma, finalsize=2*fftsize)
+    sobel = (sobel - sobel.mean(axis=(1, 2), keepdims=True))
+    # Persist the spectra once: the overlapping windows below then
+    # stream slices from memory instead of re-FFT-ing every block.
+    F = dask_spectra(sobel).persist()
     W_full = np.zeros((data.shape[0],
                        data.shape[0]))
-    M_full = np.zeros((2, data.shape[0],
-                          data.shape[0]))
+    DX_full = np.zeros((data.shape[0],
+                        data.shape[0]))
+    DY_full = np.zeros((data.shape[0],
+                        data.shape[0]))
     outer_stride = 2*stride
     for i in np.arange(start, data.shape[0], stride):
         print(i, end=' ')
         i2 = i + outer_stride
-        corr = dask_cross_corr(sobel[i:i2]) #Todo: only compute every block once.
-        W, M = calculate_halfmatrices(*max_and_argmax(corr),
-                                      fftsize=fftsize)
+        W, DX, DY = calculate_halfmatrices(*cross_corr_max(sobel[i:i2],
+                                                           spectra=F[i:i2]),
+                                           fftsize=fftsize,
+                                           diagonal=autocorr_weights(sobel[i:i2]))
         W_full[i:i2, i:i2] = W
-        M_full[:, i:i2, i:i2] = M
+        DX_full[i:i2, i:i2] = DX
+        DY_full[i:i2, i:i2] = DY
         #w_diag = np.atleast_2d(np.diag(W))
         #W_n = W / np.sqrt(w_diag.T * w_diag)
     coords, weightmatrix, DX, DY, row_mask = threshold_and_mask(min_norm,
                                                                 W_full[start:,start:],
-                                                                M_full[:,start:,start:],
+                                                                DX_full[start:,start:],
+                                                                DY_full[start:,start:],
                                                                 nr)
     dx, dy = calc_shift_vectors(DX, DY, weightmatrix)
     shifts = np.stack(interp_shifts(coords, [dx, dy], n=data.shape[0]), axis=1)
     neededMargins = np.ceil(shifts.max(axis=0)).astype(int)
     shifts = da.from_array(shifts, chunks=(dE, -1))
-
-    @da.as_gufunc(signature="(i,j),(2)->(i,j)", output_dtypes=data.dtype, vectorize=True)
-    def shift_images(image, shifts):
-        """Shift `image` by `shift` pixels."""
-        return ndi.shift(image, shift=shifts, order=1)
-    padded = da.pad(data.rechunk({0: dE}),
-                    ((0, 0),
-                     (0, neededMargins[0]),
-                     (0, neededMargins[1])
-                     ),
-                    mode='constant'
-                    )
-    corrected = shift_images(padded.rechunk({1: -1, 2: -1}), shifts)
-    return corrected, shifts, W_full, M_full
+    # The margins are padded virtually by the shift kernel
+    corrected = shift_images(data, shifts,
+                             margins=(neededMargins[0], neededMargins[1]))
+    return corrected, shifts, W_full, DX_full, DY_full